@@ -2,11 +2,9 @@
 the CaptureFile repository"""
 
 from contextlib import contextmanager
-from copy import deepcopy
 from dataclasses import InitVar, dataclass, field
-from functools import _lru_cache_wrapper, lru_cache
-from io import BytesIO
-from itertools import islice
+from functools import _lru_cache_wrapper, lru_cache, partial
+from itertools import islice, starmap
 from math import ceil
 from os import SEEK_END, SEEK_SET, lseek, remove
 from pathlib import Path
@@ -14,9 +12,23 @@ from shutil import move
 from struct import Struct
 from sys import modules
 from tempfile import NamedTemporaryFile
-from threading import Semaphore, Lock
+from threading import Lock
 from time import sleep
-from typing import IO, ClassVar, Dict, Generator, List, Optional, Set, Tuple, Union
+from typing import (
+    IO,
+    Callable,
+    ClassVar,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 from zlib import compress, crc32, decompress
 
 try:
@@ -26,6 +38,47 @@ except ModuleNotFoundError:
     # Windows. When not on Windows the Linux/Unix variant below will be imported
     import fcntl
 
+try:
+    from os import pread
+except ImportError:
+    # os.pread is not available on Windows where positioned reads fall back to
+    # a seek followed by a read
+    pread = None
+
+try:
+    from os import preadv
+except ImportError:
+    # os.preadv is not available on Windows and some older Unix variants
+    preadv = None
+
+try:
+    from os import pwrite
+except ImportError:
+    # os.pwrite is not available on Windows where positioned writes fall back
+    # to a seek followed by a write
+    pwrite = None
+
+try:
+    from os import posix_fallocate
+except ImportError:
+    # os.posix_fallocate is not available on Windows or macOS where the file is
+    # grown with truncate instead
+    posix_fallocate = None
+
+try:
+    from os import POSIX_FADV_SEQUENTIAL, posix_fadvise
+except ImportError:
+    # os.posix_fadvise is not available on Windows or macOS where the prefetch
+    # hint is ignored
+    posix_fadvise = None
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    # zstandard is an optional dependency that is only needed for capture files
+    # that were created with compression="zstd"
+    zstandard = None
+
 Record = Union[str, bytes]
 
 
@@ -69,6 +122,34 @@ class CaptureFile:
     larger number can improve the amount of compression obtained, resulting in a
     smaller CaptureFile.
 
+    By default the blocks of a new capture file are compressed with zlib. If
+    `compression` is set to "zstd" when a new file is created, then its blocks
+    are compressed with Zstandard instead, which is considerably faster to both
+    compress and decompress. Writing or reading such a file requires the
+    optional `zstandard` package. Like `compression_block_size`, `compression`
+    is only used when a new file is created since it is recorded in the file.
+
+    `compression_level` sets how hard this CaptureFile works to compress the
+    blocks it writes. For zlib it is 1 (fastest) to 9 (smallest) and for
+    Zstandard it is 1 to 22. If it is not set, the zlib default of 6 or the
+    Zstandard default of 3 is used. Highly repetitive records, like most logs,
+    often compress nearly as well at level 1 in a fraction of the time. Unlike
+    `compression`, it is not recorded in the file and can be different every
+    time the file is opened for write. A `ValueError` is raised when the file is
+    opened if the level is not supported by its compression.
+
+    Recently used blocks are kept decompressed in memory so that nearby records
+    can be read without decompressing their block again. `block_cache_size`
+    is the approximate number of bytes of decompressed blocks that this
+    CaptureFile will keep. The default of 8MB holds 256 blocks of the default
+    `compression_block_size`. Increasing it can help random access workloads
+    that repeatedly revisit a large set of blocks.
+
+    If `prefetch` is set to "sequential", then the OS is advised that the file
+    will mostly be read in order, such as when iterating over all of its
+    records, so that it reads further ahead. It is ignored on operating systems
+    without `posix_fadvise`.
+
     An `InvalidCaptureFile` exception is raised if this constructor is used to
     open a file that is not a valid capture file, is in an unsupported version
     of the capture file format, or is a corrupted.
@@ -79,15 +160,27 @@ class CaptureFile:
 
     -1 is the default compromise which currently is equivalent to 6."""
 
+    _zstd_compression_level: ClassVar[int] = 3
+    """The Zstandard compression level used for files created with
+    compression="zstd"."""
+
+    _refresh_retry_delays: ClassVar[Tuple[float, ...]] = (0, 0.001, 0.01, 0.1, 1)
+    """Seconds to wait before each retry of a refresh that found the master
+    nodes in an inconsistent state.
+
+    A commit only takes as long as writing one master node so the retries
+    start immediately and back off exponentially rather than stalling readers
+    for a fixed long time."""
+
     _lock_start_position: ClassVar[int] = 0x7FFFFFFFFFFFFFFE
     _lock_end_position: ClassVar[int] = 0x7FFFFFFFFFFFFFFF
     _lock_size: ClassVar[int] = _lock_end_position - _lock_start_position
 
-    _filenames_opened_for_write_sem: ClassVar[Semaphore] = Semaphore()
+    _filenames_opened_for_write_sem: ClassVar[Lock] = Lock()
     _filenames_opened_for_write: ClassVar[Set[Path]] = set()
     """For in-process double checking to prevent multiple to-write opens."""
 
-    _filenames_with_master_node_lock_sem: ClassVar[Semaphore] = Semaphore()
+    _filenames_with_master_node_lock_sem: ClassVar[Lock] = Lock()
     _filenames_with_master_node_lock: ClassVar[
         Dict[Path, "ReferenceCountedLock"]
     ] = dict()
@@ -99,6 +192,10 @@ class CaptureFile:
     encoding: Optional[str] = "utf_8"
     use_os_file_locking: bool = False
     compression_block_size: InitVar[int] = 32768
+    compression: InitVar[str] = "zlib"
+    block_cache_size: int = 8_388_608
+    compression_level: Optional[int] = None
+    prefetch: Optional[str] = None
 
     _file_name: Path = field(init=False)
     """A "Path" instance of file_name set during __post_init__"""
@@ -107,9 +204,18 @@ class CaptureFile:
 
     _config: "CaptureFileConfiguration" = field(init=False)
 
+    _page_size: int = field(init=False)
+    _fan_out: int = field(init=False)
+    _fan_out_shift: Optional[int] = field(init=False)
+    _master_node_size: int = field(init=False)
+    """Copies of the _config values that are used on the hot read and write
+    paths so that they are one attribute lookup away instead of two"""
+
     _file: Optional[IO[bytes]] = field(init=False, default=None)
 
-    _compression_block: "BytesStream" = field(init=False)
+    _compression_block: "BytesStream" = field(
+        init=False, default_factory=lambda: BytesStream()
+    )
 
     _current_master_node: "MasterNode" = field(init=False)
 
@@ -117,23 +223,58 @@ class CaptureFile:
 
     _record_count: int = field(init=False)
 
+    _fetch_buffer: bytearray = field(init=False, default_factory=bytearray)
+    """Reused by _fetch_data when data is split between the file and the last
+    page. It is grown as needed."""
+
+    _cached_file_limit: int = field(init=False)
+    """The file_limit of the current master node kept as a plain attribute for
+    the hot read and write paths"""
+
+    _written_limit: int = field(init=False)
+    """The file_limit rounded down to a page boundary. Data before it is in the
+    file while the data from it up to the file_limit is only in the
+    contents_of_last_page of the current master node."""
+
+    _known_file_size: int = field(init=False, default=0)
+    """A lower bound of the size of the file. Capture files never shrink so the
+    OS only needs to be asked for the size when this is too small for the next
+    write."""
+
+    _master_node_read_buffer: bytearray = field(init=False)
+    """Reused by every master node decode to avoid an allocation per refresh"""
+
+    _last_page_buffers: List[bytearray] = field(init=False)
+    """One contents_of_last_page buffer for each of the two master node
+    positions that is refilled in place each time that master node is
+    decoded"""
+
+    _master_node_write_buffer: bytearray = field(init=False)
+    """Reused by every commit to serialize the master node into"""
+
     _block_cache: _lru_cache_wrapper = field(init=False)
     _full_node_cache: _lru_cache_wrapper = field(init=False)
 
+    _compress: Callable[[bytes], bytes] = field(init=False)
+    _decompress: Callable[[bytes], bytes] = field(init=False)
+    """Compression functions for the compression used by this file. They are
+    created once per open so that the Zstandard contexts are reused."""
+
     def __post_init__(
         self,
         initial_metadata: Optional[bytes],
         force_new_empty_file: bool,
         compression_block_size: int,
+        compression: str,
     ):
-        self._block_cache = lru_cache(maxsize=10)(self._block_cache_method)
-        self._full_node_cache = lru_cache(maxsize=10)(self._full_node_cache_method)
+        if self.prefetch not in (None, "sequential"):
+            raise ValueError(f'"{self.prefetch}" is not a supported prefetch.')
 
         self._file_name = Path(self.file_name)
 
         if force_new_empty_file or (self.to_write and not self._file_name.is_file()):
             self._new_is_in_progress = True
-            self._new_file(initial_metadata, compression_block_size)
+            self._new_file(initial_metadata, compression_block_size, compression)
         self._new_is_in_progress = False
         self.open(self.to_write)
 
@@ -181,6 +322,7 @@ class CaptureFile:
                         f'Capture file "{self.file_name}" is already open for write.'
                     )
             self.to_write = to_write
+            self._known_file_size = 0
             mode = "r+b" if to_write else "rb"
             self._file = open(self.file_name, mode=mode, encoding=None)
 
@@ -206,6 +348,18 @@ class CaptureFile:
             ].add_reference()
 
         self._config = CaptureFileConfiguration.read(self._file)
+        self._init_config_values()
+        self._init_buffers()
+        try:
+            self._init_compression()
+        except ValueError:
+            self.close()
+            raise
+        self._init_caches()
+        if self.prefetch == "sequential" and posix_fadvise is not None:
+            # The OS then reads further ahead of each read, which suits reading
+            # most of the records in order
+            posix_fadvise(self._file.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
         self.refresh()
 
     def close(self):
@@ -235,7 +389,12 @@ class CaptureFile:
     def __del__(self):
         self.close()
 
-    def _new_file(self, initial_metadata: Optional[bytes], compression_block_size: int):
+    def _new_file(
+        self,
+        initial_metadata: Optional[bytes],
+        compression_block_size: int,
+        compression: str,
+    ):
         """Creates a new capture file with name `file_name`.
 
         If the file already exists, it is overwritten by the newly created file.
@@ -243,6 +402,14 @@ class CaptureFile:
         If the optional `initial_metadata` is provided, then it is guaranteed
         to be in the resulting capture file if file creation succeeds."""
 
+        if compression not in CaptureFileConfiguration.version_for_compression:
+            raise ValueError(f'"{compression}" is not a supported compression.')
+        if compression == "zstd" and zstandard is None:
+            raise ModuleNotFoundError(
+                'The zstandard package is required for compression="zstd".'
+            )
+        self._check_compression_level(compression)
+
         with CaptureFile._filenames_opened_for_write_sem:
             if self._file_name in CaptureFile._filenames_opened_for_write:
                 # Need to check explicitly because in Linux the same process can
@@ -253,9 +420,12 @@ class CaptureFile:
             CaptureFile._filenames_opened_for_write.add(self._file_name)
 
         self._config = CaptureFileConfiguration(
-            compression_block_size=compression_block_size
+            version=CaptureFileConfiguration.version_for_compression[compression],
+            compression_block_size=compression_block_size,
         )
-        self._init_compression_block()
+        self._init_config_values()
+        self._init_buffers()
+        self._init_compression()
 
         # First build the capture file as a temporary file so that we never have
         # a partially constructed (invalid) capture file. The option
@@ -272,9 +442,10 @@ class CaptureFile:
                 file_limit=self._config.initial_file_limit,
                 metadata_pointer=DataCoordinates.null(),
                 rightmost_path=RightmostPath(),
-                contents_of_last_page=bytearray(self._config.page_size),
-                compression_block_contents=self._compression_block.getvalue(),
+                contents_of_last_page=bytearray(self._page_size),
+                compression_block_contents=b"",
             )
+            self._update_file_limits()
 
             self.set_metadata(initial_metadata)
             # Create both current and previous master nodes by committing twice
@@ -297,7 +468,15 @@ class CaptureFile:
         return self
 
     def _file_limit(self, /):
-        return self._current_master_node.file_limit
+        return self._cached_file_limit
+
+    def _update_file_limits(self, /):
+        """Must be called whenever the file_limit of the current master node
+        changes"""
+
+        page_size = self._page_size
+        self._cached_file_limit = self._current_master_node.file_limit
+        self._written_limit = self._cached_file_limit // page_size * page_size
 
     def _decode_master_nodes(self, /) -> List[Optional["MasterNode"]]:
         """Return both MasterNodes from the data.
@@ -305,60 +484,204 @@ class CaptureFile:
         If a node has a bad CRC, its value will be None"""
 
         return [
-            self._decode_master_node(position)
-            for position in self._config.master_node_positions
+            self._decode_master_node(position, last_page_buffer)
+            for position, last_page_buffer in zip(
+                self._config.master_node_positions, self._last_page_buffers
+            )
         ]
 
-    def _decode_master_node(self, node_position: int, /) -> Optional["MasterNode"]:
-        """Return a MasterNode from the data starting at node_position.
+    def _decode_master_node(
+        self, node_position: int, last_page_buffer: bytearray, /
+    ) -> Optional["MasterNode"]:
+        """Return a MasterNode from the data starting at node_position whose
+        contents_of_last_page is last_page_buffer refilled in place.
 
         If the node has a bad CRC, return None"""
-        assert self._file
-        self._file.seek(node_position)
-        recorded_crc32 = self._file.read(4)
-        master_node_buffer = self._file.read(self._config.master_node_size - 4)
-        recorded_crc32_int = int.from_bytes(recorded_crc32, byteorder="big")
-        computed_crc32 = crc32(master_node_buffer) & 0xFFFFFFFF
+        # Read the CRC and the rest of the master node in a single positioned
+        # read into the reusable buffer. Everything MasterNode.new_from keeps is
+        # copied out of it so it can be overwritten by the next decode.
+        buffer = self._master_node_read_buffer
+        self._read_into_at(node_position, memoryview(buffer))
+        (recorded_crc32_int,) = MasterNode.crc_struct.unpack_from(buffer, 0)
+        master_node_buffer = memoryview(buffer)[MasterNode.crc_struct.size :]
+        # zlib.crc32 already returns an unsigned 32-bit value
+        computed_crc32 = crc32(master_node_buffer)
         if recorded_crc32_int != computed_crc32:
             return None
         else:
-            return MasterNode.new_from(master_node_buffer, self._config.page_size)
+            return MasterNode.new_from(
+                master_node_buffer, self._page_size, last_page_buffer
+            )
 
-    def _fetch_sized_data(self, start_position: int, /) -> bytes:
-        buffer = self._fetch_data(start_position, 4)
-        size = int.from_bytes(buffer, byteorder="big")
-        return self._fetch_data(start_position + 4, size)
+    def _fetch_sized_data(self, start_position: int, /) -> memoryview:
+        # Speculatively fetch the beginning of the data together with its size
+        # prefix so that small blocks, such as metadata, need only a single
+        # read. The first read is capped at a page so that larger blocks do not
+        # pull in much more than they need; the rest is read once the size is
+        # known.
+        size_prefix_size = DataCoordinates.block_size_struct.size
+        buffer = self._fetch_data(
+            start_position,
+            min(
+                self._page_size, size_prefix_size + self._config.compression_block_size
+            ),
+        )
+        (size,) = DataCoordinates.block_size_struct.unpack_from(buffer, 0)
+        end = size_prefix_size + size
+        if end <= len(buffer):
+            return buffer[size_prefix_size:end]
+        return memoryview(
+            b"".join(
+                (
+                    buffer[size_prefix_size:],
+                    self._fetch_data(start_position + len(buffer), end - len(buffer)),
+                )
+            )
+        )
 
-    def _fetch_data(self, start_position: int, size: int, /) -> bytes:
+    def _fetch_data(self, start_position: int, size: int, /) -> memoryview:
+        """Return a view of the `size` bytes at `start_position` which must be
+        used before the unwritten buffer is next modified"""
 
-        assert self._file
-        written_limit = (
-            self._file_limit() // self._config.page_size * self._config.page_size
-        )
+        written_limit = self._written_limit
         end_position = start_position + size
         if start_position < written_limit:
-            self._file.seek(start_position)
             if end_position <= written_limit:
                 # Entirely within the file.
-                sized_data = self._file.read(size)
+                sized_data = memoryview(self._read_at(start_position, size))
             else:
-                # Split between file and unwritten buffer.
+                # Split between file and unwritten buffer. Both parts are
+                # copied into the reusable fetch buffer so that only the
+                # returned bytes are allocated.
                 written_size = written_limit - start_position
-                unwritten_size = size - written_size
-                sized_data = (
-                    self._file.read(written_size)
-                    + self._current_master_node.contents_of_last_page[0:unwritten_size]
-                )
+                unwritten = memoryview(self._current_master_node.contents_of_last_page)[
+                    : size - written_size
+                ]
+                total_size = written_size + len(unwritten)
+                if len(self._fetch_buffer) < total_size:
+                    self._fetch_buffer = bytearray(total_size)
+                fetch_buffer = memoryview(self._fetch_buffer)
+                if (
+                    self._read_into_at(start_position, fetch_buffer[:written_size])
+                    < written_size
+                ):
+                    raise InvalidCaptureFile(
+                        "Invalid capture file -- it ends before its committed data."
+                    )
+                fetch_buffer[written_size:total_size] = unwritten
+                sized_data = memoryview(bytes(fetch_buffer[:total_size]))
         else:
             # Entirely within the unwritten buffer.
             unwritten_start = start_position - written_limit
-            sized_data = self._current_master_node.contents_of_last_page[
+            sized_data = memoryview(self._current_master_node.contents_of_last_page)[
                 unwritten_start : unwritten_start + size
             ]
         return sized_data
 
+    def _read_at(self, position: int, size: int, /) -> bytes:
+        """Read `size` bytes starting at `position`.
+
+        Where os.pread is available the seek and read are done in a single
+        system call that does not move the shared file position."""
+
+        assert self._file
+        if pread is not None:
+            return pread(self._file.fileno(), size, position)
+        self._file.seek(position)
+        return self._file.read(size)
+
+    def _read_into_at(self, position: int, buffer: memoryview, /) -> int:
+        """Fill `buffer` with the bytes starting at `position` and return how
+        many were read.
+
+        If the file ends before `buffer` is full then the rest of `buffer` is
+        zeroed so that bytes left from an earlier read are never decoded."""
+
+        assert self._file
+        if preadv is not None:
+            bytes_read = preadv(self._file.fileno(), [buffer], position)
+        else:
+            self._file.seek(position)
+            bytes_read = self._file.readinto(buffer) or 0
+        if bytes_read < len(buffer):
+            buffer[bytes_read:] = zero_bytes(len(buffer) - bytes_read)
+        return bytes_read
+
+    def _write_at(self, position: int, data: bytes, /):
+        """Write all of `data` starting at `position`.
+
+        Where os.pwrite is available the seek and write are done in a single
+        system call that bypasses the buffer of the Python file object."""
+
+        assert self._file
+        if pwrite is not None:
+            view = memoryview(data)
+            while view:
+                written = pwrite(self._file.fileno(), view, position)
+                view = view[written:]
+                position += written
+        else:
+            self._file.seek(position)
+            self._file.write(data)
+
+    def _init_config_values(self, /):
+        self._page_size = self._config.page_size
+        self._fan_out = self._config.fan_out
+        self._fan_out_shift = self._config.fan_out_shift
+        self._master_node_size = self._config.master_node_size
+
+    def _init_buffers(self, /):
+        self._master_node_read_buffer = bytearray(self._master_node_size)
+        self._last_page_buffers = [
+            bytearray(self._page_size),
+            bytearray(self._page_size),
+        ]
+        self._master_node_write_buffer = bytearray(self._master_node_size)
+
+    def _check_compression_level(self, compression: str, /):
+        # An invalid level would otherwise only be reported by the compressor
+        # when the first block is written, after its records were added
+        level = self.compression_level
+        if level is None:
+            return
+        if compression == "zstd":
+            is_valid = level <= zstandard.MAX_COMPRESSION_LEVEL
+        else:
+            is_valid = -1 <= level <= 9
+        if not is_valid:
+            raise ValueError(
+                f'{level} is not a valid compression level for "{compression}".'
+            )
+
+    def _init_compression(self, /):
+        self._check_compression_level(self._config.compression)
+        if self._config.compression == "zstd":
+            self._compress = zstandard.ZstdCompressor(
+                level=CaptureFile._zstd_compression_level
+                if self.compression_level is None
+                else self.compression_level
+            ).compress
+            self._decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            self._compress = partial(
+                compress,
+                level=CaptureFile._compression_level
+                if self.compression_level is None
+                else self.compression_level,
+            )
+            self._decompress = decompress
+
+    def _init_caches(self, /):
+        # The caches can only be sized once the compression block size of the
+        # file is known. There is one full node cache entry per cached block
+        # since full nodes are small compared to the blocks they are read from.
+        maxsize = max(1, self.block_cache_size // self._config.compression_block_size)
+        self._block_cache = lru_cache(maxsize=maxsize)(self._block_cache_method)
+        self._full_node_cache = lru_cache(maxsize=maxsize)(self._full_node_cache_method)
+
     def _init_compression_block(self, /):
-        self._compression_block = BytesStream()
+        # The same stream is reused for each compression block by the writer
+        self._compression_block.clear()
 
     def refresh(self, /):
         """Updates the internal structures of this capture file object to
@@ -381,18 +704,14 @@ class CaptureFile:
         # this method retries the call in case the master nodes were temporarily
         # not exactly one sequence number apart
         try:
-            for retry_count in range(0, 3):
+            for delay in CaptureFile._refresh_retry_delays:
                 try:
                     self.__refresh()
                     break
-                except InvalidCaptureFile as ex:
-                    if retry_count == 0:
-                        continue
-                    elif retry_count == 1:
-                        sleep(4)
-                        continue
-                    else:
-                        raise ex
+                except InvalidCaptureFile:
+                    sleep(delay)
+            else:
+                self.__refresh()
         except Exception as ex:
             self.close()
             raise ex
@@ -416,13 +735,18 @@ class CaptureFile:
                 current_master_node_index = 0 if nodes[0] is not None else 1
 
             self._current_master_node = nodes[current_master_node_index]
+            self._update_file_limits()
+            # The metadata may have changed so it will be read again when next
+            # requested
+            self._metadata = None
 
+            # A new stream is used here rather than clearing the current one
+            # since a record_generator of a reader may still be viewing it
             self._compression_block = BytesStream(
                 self._current_master_node.compression_block_contents
             )
-            self._compression_block.seek(0, SEEK_END)
             self._record_count = self._current_master_node.compute_record_count(
-                self._config.fan_out
+                self._fan_out
             )
 
     def __enter__(self, /):
@@ -549,11 +873,17 @@ class CaptureFile:
                 " for writing."
             )
 
-        self._metadata = new_metadata
+        if new_metadata == self.get_metadata():
+            # Setting the same metadata again would only store another copy
+            return
+
+        # Keep an immutable copy so that later changes to a mutable buffer
+        # passed in are not mistaken for metadata that was already stored
+        self._metadata = None if new_metadata is None else bytes(new_metadata)
         self._current_master_node.metadata_pointer = (
             DataCoordinates.null()
-            if new_metadata is None
-            else self._add_data_block(new_metadata)
+            if self._metadata is None
+            else self._add_data_block(self._metadata)
         )
 
     def __iter__(self, /):
@@ -564,8 +894,7 @@ class CaptureFile:
             if key.step in (1, None):
                 # If we are stepping by +1 then the most efficient method is to
                 # use a record_generator starting at key.start, for anything
-                # else we may as well use the record_at method and fetch each
-                # record directly.
+                # else the records are fetched directly by _records_at.
                 start = 1 if key.start is None else key.start
                 if key.stop is None:
                     return list(self.record_generator(key.start))
@@ -575,7 +904,7 @@ class CaptureFile:
                     )
             else:
                 indices = range(*key.indices(self._record_count))
-                return [self.record_at(i) for i in indices]
+                return self._records_at(indices)
         return self.record_at(key)
 
     def record_generator(
@@ -611,14 +940,14 @@ class CaptureFile:
         # returned. If that is desired then a new record_generator should be
         # requested if the number of records has increased post creation of the
         # record_generator
-        rightmost_path = deepcopy(self._current_master_node.rightmost_path)
+        rightmost_path = self._current_master_node.rightmost_path.snapshot()
 
         height = rightmost_path.number_of_levels()
         return self._record_generator(
             starting_record_number - 1,
             rightmost_path,
             height,
-            self._config.fan_out**height,
+            self._fan_out**height,
         )
 
     def _record_generator(
@@ -631,7 +960,7 @@ class CaptureFile:
     ) -> Generator[Record, None, None]:
 
         rightmost_node = rightmost_path.rightmost_node(height)
-        power = power // self._config.fan_out
+        power = power // self._fan_out
 
         (starting_child_index, index_remaining) = divmod(index_remaining, power)
 
@@ -660,19 +989,20 @@ class CaptureFile:
         power: int,
         /,
     ) -> Generator[Record, None, None]:
-        power = power // self._config.fan_out
+        power = power // self._fan_out
 
         (starting_child_index, index_remaining) = divmod(index_remaining, power)
 
         block = self._block(starting_node.compressed_block_start)
-        offset = (
+        start = (
             starting_node.data_start
             + DataCoordinates.struct.size * starting_child_index
         )
+        end = starting_node.data_start + self._config.full_node_size
 
-        for _ in range(starting_child_index, self._config.fan_out):
-            child_node = DataCoordinates.from_bytes(block, offset)
-            offset += DataCoordinates.struct.size
+        for child_node in starmap(
+            DataCoordinates, DataCoordinates.struct.iter_unpack(block[start:end])
+        ):
             if height == 1:
                 yield child_node.record(self)
             else:
@@ -705,22 +1035,19 @@ class CaptureFile:
         if record_number < 1 or record_number > self._record_count:
             raise IndexError
         rightmost_nodes = self._current_master_node.rightmost_path.rightmost_nodes
-        # Use "reversed" so we start at the root instead of the leaves
-        root_to_leaf_rightmost_nodes = reversed(rightmost_nodes)
-        root_to_leaf_path = reversed(
-            leaf_to_root_path(
-                # 1 is subtracted from record_number because Python is
-                # 0-based while CaptureFile records start at 1
-                record_number - 1,
-                len(rightmost_nodes),
-                self._config.fan_out,
-            )
+        path = root_to_leaf_path(
+            # 1 is subtracted from record_number because Python is 0-based
+            # while CaptureFile records start at 1
+            record_number - 1,
+            len(rightmost_nodes),
+            self._fan_out,
+            self._fan_out_shift,
         )
 
-        # skip nodes as long as path follows rightmost nodes.
-        for child_index, current_rightmost_node in zip(
-            root_to_leaf_path, root_to_leaf_rightmost_nodes
-        ):
+        # skip nodes as long as path follows rightmost nodes. The rightmost
+        # nodes are stored leaf to root so they are indexed from the end.
+        for depth, child_index in enumerate(path):
+            current_rightmost_node = rightmost_nodes[-1 - depth]
             if child_index != len(current_rightmost_node.children):
                 break
 
@@ -731,13 +1058,73 @@ class CaptureFile:
 
         # iterate through the remainder of the path of child indexes until we
         # arrive at the data coordinates of the record
-        for child_index in root_to_leaf_path:
+        for child_index in path[depth + 1 :]:
             current_child_coordinates = self._full_node_cache(
-                current_child_coordinates
+                current_child_coordinates.compressed_block_start,
+                current_child_coordinates.data_start,
             )[child_index]
 
         return current_child_coordinates.record(self)
 
+    def _records_at(self, record_numbers: Sequence[int], /) -> List[Record]:
+        """Returns the records stored at each of the passed `record_numbers`
+        in the same order.
+
+        This is equivalent to calling `record_at` for each record number but
+        the records are located in ascending order so that each index node on
+        the path shared by neighbouring records is only looked up once."""
+
+        if not self._file:
+            raise CaptureFileNotOpen(
+                f'Cannot get record from "{self.file_name}" because it is not open.'
+            )
+
+        order = sorted(range(len(record_numbers)), key=record_numbers.__getitem__)
+        if not order:
+            return []
+        if (
+            record_numbers[order[0]] < 1
+            or record_numbers[order[-1]] > self._record_count
+        ):
+            raise IndexError
+
+        rightmost_nodes = self._current_master_node.rightmost_path.rightmost_nodes
+        height = len(rightmost_nodes)
+        fan_out = self._fan_out
+        fan_out_shift = self._fan_out_shift
+        records: List[Record] = [b""] * len(record_numbers)
+
+        # children[depth] holds the children of the node at that depth of the
+        # current path. A node's children only depend on the part of the path
+        # above it, so when moving to the next record only the levels below
+        # where its path first differs from the previous path are looked up.
+        children: List[Sequence[DataCoordinates]] = [rightmost_nodes[-1].children]
+        children.extend([()] * (height - 1))
+        previous_path: List[int] = []
+        for position in order:
+            path = root_to_leaf_path(
+                record_numbers[position] - 1, height, fan_out, fan_out_shift
+            )
+            depth = 0
+            for depth, (child_index, previous_child_index) in enumerate(
+                zip(path, previous_path)
+            ):
+                if child_index != previous_child_index:
+                    break
+            for depth in range(depth + 1, height):
+                parent_children = children[depth - 1]
+                child_index = path[depth - 1]
+                if child_index == len(parent_children):
+                    # The path continues through a rightmost node
+                    children[depth] = rightmost_nodes[-1 - depth].children
+                else:
+                    children[depth] = self._full_node_cache(
+                        *parent_children[child_index]
+                    )
+            records[position] = children[-1][path[-1]].record(self)
+            previous_path = path
+        return records
+
     def record_count(self, /) -> int:
         """Returns the number of records available when the file was opened or
         last refreshed. If opened for write, the record count is up-to-date with
@@ -746,11 +1133,21 @@ class CaptureFile:
         return self._record_count
 
     def _full_node_cache_method(
-        self, child: "DataCoordinates", /
+        self, compressed_block_start: int, data_start: int, /
     ) -> Tuple["DataCoordinates", ...]:
-        block = self._block(child.compressed_block_start)
-        tup = self._config.full_node_struct.unpack_from(block, child.data_start)
-        return tuple(DataCoordinates(tup[i], tup[i + 1]) for i in range(0, len(tup), 2))
+        # The full node is identified by the two bare ints of its coordinates
+        # rather than by a DataCoordinates so that the C implementation of
+        # lru_cache can hash and compare the key without calling back into the
+        # dataclass-generated __hash__ and __eq__.
+        block = self._block(compressed_block_start)
+        return tuple(
+            starmap(
+                DataCoordinates,
+                DataCoordinates.struct.iter_unpack(
+                    block[data_start : data_start + self._config.full_node_size]
+                ),
+            )
+        )
 
     def _block(self, file_position: int, /) -> memoryview:
         # The block cache never needs to be cleared, because it only holds full
@@ -762,13 +1159,13 @@ class CaptureFile:
             # it is not cached but just returned if file_position is at
             # file_limit.
             self._compression_block.getbuffer()
-            if file_position == self._file_limit()
+            if file_position == self._cached_file_limit
             else self._block_cache(file_position)
         )
 
     def _block_cache_method(self, file_position: int, /) -> memoryview:
         compressed_bytes = self._fetch_sized_data(file_position)
-        uncompressed_bytes = decompress(compressed_bytes)
+        uncompressed_bytes = self._decompress(compressed_bytes)
         return memoryview(uncompressed_bytes)
 
     def _file_size(self, /) -> int:
@@ -776,68 +1173,94 @@ class CaptureFile:
         self._file.seek(0, SEEK_END)
         return self._file.tell()
 
-    def _write_full_pages(self, raw_bytes: bytes, /):
-        """Append `raw_bytes` to the end of the file data (file_limit) in full
-        page increments.
+    def _write_full_pages(self, *pieces: bytes):
+        """Append the concatenation of `pieces` to the end of the file data
+        (file_limit) in full page increments.
 
         Remaining partial page data is held in the master node until next time
         when it is written as the beginning of the first full page."""
 
         assert self._file
-        pos_in_last_page = self._file_limit() % self._config.page_size
-        total_len = pos_in_last_page + len(raw_bytes)
-        full_pages_len = total_len // self._config.page_size * self._config.page_size
+        page_size = self._page_size
+        contents_of_last_page = self._current_master_node.contents_of_last_page
+        pos_in_last_page = self._cached_file_limit % page_size
+        data_len = sum(map(len, pieces))
+        total_len = pos_in_last_page + data_len
+        full_pages_len = total_len // page_size * page_size
         if full_pages_len > 0:
-            self._file.seek(
-                self._file_limit() // self._config.page_size * self._config.page_size
-            )
-            self._file.write(
-                self._current_master_node.contents_of_last_page[:pos_in_last_page]
-            )
             full_page_remainder_len = full_pages_len - pos_in_last_page
-            self._file.write(raw_bytes[:full_page_remainder_len])
-            raw_bytes_remainder_len = len(raw_bytes) - full_page_remainder_len
-            unwritten_page_len = self._config.page_size - raw_bytes_remainder_len
-            self._current_master_node.contents_of_last_page[
-                :raw_bytes_remainder_len
-            ] = raw_bytes[full_page_remainder_len:]
-            self._current_master_node.contents_of_last_page[
-                raw_bytes_remainder_len:
-            ] = (b"\x00" * unwritten_page_len)
+            # Join the start of the last page with the pieces so the full pages
+            # are written with a single write while each piece is copied once
+            to_write = [memoryview(contents_of_last_page)[:pos_in_last_page]]
+            remainders = []
+            offset = 0
+            for piece in pieces:
+                view = memoryview(piece)
+                split = max(0, min(len(view), full_page_remainder_len - offset))
+                to_write.append(view[:split])
+                remainders.append(view[split:])
+                offset += len(view)
+            self._write_at(self._written_limit, b"".join(to_write))
+            position = 0
+            for remainder in remainders:
+                contents_of_last_page[position : position + len(remainder)] = remainder
+                position += len(remainder)
+            contents_of_last_page[position:] = zero_bytes(page_size - position)
         else:
-            self._current_master_node.contents_of_last_page[
-                pos_in_last_page:total_len
-            ] = raw_bytes
-        self._current_master_node.file_limit += len(raw_bytes)
+            position = pos_in_last_page
+            for piece in pieces:
+                contents_of_last_page[position : position + len(piece)] = piece
+                position += len(piece)
+        self._current_master_node.file_limit += data_len
+        self._update_file_limits()
 
     def _compress_and_write_if_full(self, /):
         if self._compression_block.tell() >= self._config.compression_block_size:
             # The compression block is full. Compress it and write it to the file.
-            compressed = compress(
-                self._compression_block.getvalue(), CaptureFile._compression_level
-            )
+            # The temporary view is released as soon as compress returns so the
+            # stream can be cleared right after
+            compressed = self._compress(self._compression_block.getbuffer())
             self._init_compression_block()
-            file_size = self._file_size()
-            if self._file_limit() + 4 + len(compressed) > file_size:
-                # Grow file by 5MB at a time (but never more than doubling) to
-                # avoid fragmentation. Prevent the file.truncate() below from
-                # attempting to re-read whatever page of data is at the current
-                # position.  Otherwise it could in theory conflict with a lock
-                # held by another OS process, leading to failure. Positioning it
-                # to zero is safe, since that page contains the file's permanent
-                # metadata and is never rewritten.
-                self._file.seek(0, SEEK_SET)
-                growth = (
-                    ceil(min(5242880, self._file_limit()) / self._config.page_size)
-                    * self._config.page_size
-                )
-                self._file.truncate(file_size + growth)
-            int_as_bytes = int.to_bytes(len(compressed), 4, "big", signed=False)
-            self._write_full_pages(int_as_bytes)
-            self._write_full_pages(compressed)
+            required_file_size = self._file_limit() + 4 + len(compressed)
+            if required_file_size > self._known_file_size:
+                file_size = self._file_size()
+                if required_file_size > file_size:
+                    # Grow file by 5MB at a time (but never more than doubling)
+                    # to avoid fragmentation.
+                    growth = (
+                        ceil(min(5242880, self._file_limit()) / self._page_size)
+                        * self._page_size
+                    )
+                    self._grow_file(file_size, growth)
+                    file_size += growth
+                self._known_file_size = file_size
+            self._write_full_pages(
+                DataCoordinates.block_size_struct.pack(len(compressed)), compressed
+            )
+
+    def _grow_file(self, file_size: int, growth: int, /):
+        """Extend the file from `file_size` by `growth` zero bytes"""
+
+        if posix_fallocate is not None:
+            # Reserving the space with fallocate lets the file system allocate
+            # it in as few extents as possible and does not go through the
+            # Python file object at all
+            try:
+                posix_fallocate(self._file.fileno(), file_size, growth)
+                return
+            except OSError:
+                # Not every file system supports fallocate
+                pass
+        # Prevent the file.truncate() below from attempting to re-read whatever
+        # page of data is at the current position. Otherwise it could in theory
+        # conflict with a lock held by another OS process, leading to failure.
+        # Positioning it to zero is safe, since that page contains the file's
+        # permanent metadata and is never rewritten.
+        self._file.seek(0, SEEK_SET)
+        self._file.truncate(file_size + growth)
 
     def _coordinates_for_next_new_data_block(self, /) -> "DataCoordinates":
-        return DataCoordinates(self._file_limit(), self._compression_block.tell())
+        return DataCoordinates(self._cached_file_limit, self._compression_block.tell())
 
     def _add_data_block(self, data_block: bytes, /) -> "DataCoordinates":
         """Add the passed data block to the file without committing it and return its
@@ -862,6 +1285,38 @@ class CaptureFile:
         If the capture file is open for read but not for write, then it will
         raise a `CaptureFileNotOpenForWrite` exception."""
 
+        return self.add_bytes_record(
+            record if isinstance(record, bytes) else record.encode()
+        )
+
+    def add_str_record(self, record: str, /) -> int:
+        """Encodes the passed string `record`, adds it to this capture file
+        without committing it and returns the new record count.
+
+        This is the same as `add_record` for a string but skips checking the
+        type of the record.
+
+        If this capture file is not open, then this method will raise a
+        `CaptureFileNotOpen` exception.
+
+        If the capture file is open for read but not for write, then it will
+        raise a `CaptureFileNotOpenForWrite` exception."""
+
+        return self.add_bytes_record(record.encode())
+
+    def add_bytes_record(self, record: bytes, /) -> int:
+        """Adds the passed binary `record` to this capture file without
+        committing it and returns the new record count.
+
+        This is the same as `add_record` for bytes but skips checking the type
+        of the record.
+
+        If this capture file is not open, then this method will raise a
+        `CaptureFileNotOpen` exception.
+
+        If the capture file is open for read but not for write, then it will
+        raise a `CaptureFileNotOpenForWrite` exception."""
+
         if not self._file:
             raise CaptureFileNotOpen(
                 f'Cannot add a record to "{self.file_name}" because it is not open.'
@@ -874,24 +1329,84 @@ class CaptureFile:
             )
 
         self._current_master_node.rightmost_path.add_child_to_rightmost_node(
-            self._add_data_block(
-                record if isinstance(record, bytes) else record.encode()
-            ),
-            1,
-            self,
+            self._add_data_block(record), 1, self
         )
         self._record_count += 1
         return self._record_count
 
+    def add_records(self, records: Iterable[Record], /) -> int:
+        """Adds each of the passed `records` to this capture file, in order,
+        without committing them and returns the new record count.
+
+        This is equivalent to calling `add_record` for each record but it is
+        faster when adding many records at once.
+
+        If this capture file is not open, then this method will raise a
+        `CaptureFileNotOpen` exception.
+
+        If the capture file is open for read but not for write, then it will
+        raise a `CaptureFileNotOpenForWrite` exception."""
+
+        if not self._file:
+            raise CaptureFileNotOpen(
+                f'Cannot add records to "{self.file_name}" because it is not open.'
+            )
+
+        if not self.to_write:
+            raise CaptureFileNotOpenForWrite(
+                f'Cannot add records to "{self.file_name}" because it is not open'
+                " for writing."
+            )
+
+        compression_block = self._compression_block
+        compression_block_size = self._config.compression_block_size
+        rightmost_path = self._current_master_node.rightmost_path
+        # The leaf RightmostNode keeps the same list of children when it is
+        # written out and reset so the list can be appended to directly. Only
+        # the child that fills it needs to go through
+        # add_child_to_rightmost_node so that it is written out and added to
+        # its parent.
+        leaf_children = rightmost_path.rightmost_node(1).children
+        last_child_index = self._fan_out - 1
+        record_count = self._record_count
+        try:
+            for record in records:
+                coordinates = DataCoordinates(
+                    self._cached_file_limit, compression_block.tell()
+                )
+                compression_block.write_sized(
+                    record if isinstance(record, bytes) else record.encode()
+                )
+                if compression_block.tell() >= compression_block_size:
+                    self._compress_and_write_if_full()
+                if len(leaf_children) == last_child_index:
+                    rightmost_path.add_child_to_rightmost_node(coordinates, 1, self)
+                else:
+                    leaf_children.append(coordinates)
+                record_count += 1
+        finally:
+            # Keep the count of the records that were added even if the
+            # records iterable raised part way through
+            self._record_count = record_count
+        return record_count
+
     def _write_master_node(self, /):
-        self._current_master_node.compression_block_contents = (
-            self._compression_block.getvalue()
-        )
-        master_node_buffer = self._current_master_node.as_bytes(self._config)
-        crc = crc32(master_node_buffer) & 0xFFFFFFFF
-        crc_as_bytes = int.to_bytes(crc, 4, "big", signed=False)
-        self._file.write(crc_as_bytes)
-        self._file.write(master_node_buffer)
+        # The compression block is serialized straight from a view of the
+        # stream. The view must be released before the stream can grow again so
+        # it is only held by the master node while it is written.
+        with self._compression_block.getbuffer() as compression_block_contents:
+            self._current_master_node.compression_block_contents = (
+                compression_block_contents
+            )
+            # The CRC is part of the buffer so the whole master node goes out in
+            # a single write
+            self._write_at(
+                self._current_master_node.position(self._config),
+                self._current_master_node.write_into(
+                    self._master_node_write_buffer, self._config
+                ),
+            )
+        self._current_master_node.compression_block_contents = b""
 
     def commit(self, /):
         """Commits records added to the capture file and any metadata
@@ -923,7 +1438,6 @@ class CaptureFile:
         self._file.flush()
         self._current_master_node.increment_serial_number()
         with self._acquire_master_nodes_lock():
-            self._file.seek(self._current_master_node.position(self._config))
             self._write_master_node()
             self._file.flush()
 
@@ -959,6 +1473,10 @@ class CaptureFileConfiguration:
     """The maximum number of children in the index tree's nodes. For more
     information about the tree structure and usage see DESIGN.md"""
 
+    compression: str = field(init=False)
+    """The compression of the blocks in the file, which is determined by the
+    version"""
+
     master_node_size: int = field(init=False)
 
     master_node_positions: Tuple[int] = field(init=False)
@@ -966,12 +1484,32 @@ class CaptureFileConfiguration:
 
     compression_block_start: int = field(init=False)
     initial_file_limit: int = field(init=False)
-    full_node_struct: Struct = field(init=False)
+    full_node_size: int = field(init=False)
+    """The number of bytes of a full node written in the data section"""
+
+    fan_out_shift: Optional[int] = field(init=False)
+    """log2 of fan_out when fan_out is a power of two, which it is by default,
+    so that child indexes can be computed with shifts and masks. Otherwise
+    None."""
 
-    current_version: ClassVar[int] = 2
+    current_version: ClassVar[int] = 3
     """The code's current version which can support any earlier version
     recorded in the file"""
 
+    version_for_compression: ClassVar[Dict[str, int]] = {"zlib": 2, "zstd": 3}
+    """The version recorded in new files for each supported compression.
+    Files compressed with zlib keep version 2 so that they remain readable by
+    code that predates Zstandard support."""
+
+    compression_for_version: ClassVar[Dict[int, str]] = {
+        1: "zlib",
+        2: "zlib",
+        3: "zstd",
+    }
+    """The compression of the blocks in files of each supported version. A
+    future version must be added here explicitly rather than being assumed to
+    use the compression of an earlier one."""
+
     capture_file_type: ClassVar[bytes] = b"MioCapture\0"
 
     struct: ClassVar[Struct] = Struct(f">{len(capture_file_type)}s4L")
@@ -983,6 +1521,9 @@ class CaptureFileConfiguration:
             self.compression_block_size % self.page_size == 0
         ), "compression block size must be a multiple of page size"
 
+        self.compression = CaptureFileConfiguration.compression_for_version[
+            self.version
+        ]
         self.master_node_size = self.page_size * 2 + self.compression_block_size
 
         # The first master_node starts at page_size because the entire first
@@ -999,7 +1540,12 @@ class CaptureFileConfiguration:
         last_master_page_end = last_master_page_start + self.page_size
         self.compression_block_start = last_master_page_end
         self.initial_file_limit = self.master_node_positions[1] + self.master_node_size
-        self.full_node_struct = Struct(">" + "QL" * self.fan_out)
+        self.full_node_size = DataCoordinates.struct.size * self.fan_out
+        self.fan_out_shift = (
+            self.fan_out.bit_length() - 1
+            if self.fan_out & (self.fan_out - 1) == 0
+            else None
+        )
 
     @classmethod
     def read(cls, file: IO[bytes], /) -> "CaptureFileConfiguration":
@@ -1033,15 +1579,27 @@ class CaptureFileConfiguration:
                 f"{file.name} was created in version {version} format. The highest"
                 f" version supported by this program is {cls.current_version}."
             )
+
+        if version not in cls.compression_for_version:
+            raise InvalidCaptureFile(
+                f"{file.name} was created in version {version} format, which is not"
+                " supported by this program."
+            )
+
+        if cls.compression_for_version[version] == "zstd" and zstandard is None:
+            raise InvalidCaptureFile(
+                f"{file.name} is compressed with Zstandard, which requires the"
+                " zstandard package to be installed."
+            )
         return cls(version, page_size, compression_block_size, fan_out)
 
-    def write(self, file, /):
+    def write(self, file: IO[bytes], /):
         buffer = bytearray(self.initial_file_limit)
         CaptureFileConfiguration.struct.pack_into(
             buffer,
             0,
             CaptureFileConfiguration.capture_file_type,
-            self.current_version,
+            self.version,
             self.page_size,
             self.compression_block_size,
             self.fan_out,
@@ -1063,6 +1621,9 @@ class MasterNode:
     struct: ClassVar[Struct] = Struct(f">LQL")
     """Struct = serial_number, file_limit, compression_block_len ">LQL" """
 
+    crc_struct: ClassVar[Struct] = Struct(">L")
+    """Big-endian unsigned long ">L" of the CRC that precedes each MasterNode"""
+
     serial_number: int
     """MasterNode with largest serial_number is the active one
 
@@ -1088,13 +1649,31 @@ class MasterNode:
 
     end = file_limit, not the actual end of the file"""
 
-    compression_block_contents: bytes
+    compression_block_contents: Union[bytes, memoryview]
     """Place to store data that will eventually be compressed and written out at
     the file_limit once there is  at least compression_block_size data
-    present"""
+    present
+
+    A writer keeps this data in its own compression block stream and only sets
+    it to a view of that stream while the master node is being written."""
 
     @classmethod
-    def new_from(cls, master_node_buffer: bytes, page_size: int, /) -> "MasterNode":
+    def new_from(
+        cls,
+        master_node_buffer: bytes,
+        page_size: int,
+        contents_of_last_page: Optional[bytearray] = None,
+        /,
+    ) -> "MasterNode":
+        """Return the MasterNode stored in master_node_buffer.
+
+        If contents_of_last_page is passed, it is refilled in place and used by
+        the MasterNode instead of allocating a new bytearray. It must be
+        page_size long."""
+
+        # Slicing a memoryview does not copy so the two parts of the buffer that
+        # are kept are only copied once each, into their own objects
+        master_node_buffer = memoryview(master_node_buffer)
         (serial_number, file_limit, compression_block_len) = cls.struct.unpack_from(
             master_node_buffer, 0
         )
@@ -1107,19 +1686,22 @@ class MasterNode:
         rightmost_path = RightmostPath(
             master_node_buffer, cls.struct.size + DataCoordinates.struct.size
         )
+        # since the 4-byte crc is not in the master_node_buffer but the
+        # "page size" did include it, subtract 4 to correct for this
+        last_page = master_node_buffer[page_size - 4 : compression_block_start]
+        if contents_of_last_page is None:
+            contents_of_last_page = bytearray(last_page)
+        else:
+            contents_of_last_page[:] = last_page
         return cls(
             serial_number=serial_number,
             file_limit=file_limit,
             metadata_pointer=metadata_pointer,
             rightmost_path=rightmost_path,
-            # since the 4-byte crc is not in the master_node_buffer but the
-            # "page size" did include it, subtract 4 to correct for this
-            contents_of_last_page=bytearray(
-                master_node_buffer[page_size - 4 : compression_block_start]
+            contents_of_last_page=contents_of_last_page,
+            compression_block_contents=bytes(
+                master_node_buffer[compression_block_start:compression_block_end]
             ),
-            compression_block_contents=master_node_buffer[
-                compression_block_start:compression_block_end
-            ],
         )
 
     def compute_record_count(self, fan_out: int, /) -> int:
@@ -1141,33 +1723,48 @@ class MasterNode:
         position"""
         return config.master_node_positions[self.serial_number % 2]
 
-    def as_bytes(self, config: CaptureFileConfiguration, /) -> bytes:
-        """Returns a binary representation of this MasterNode for writing"""
+    def write_into(
+        self, buffer: bytearray, config: CaptureFileConfiguration, /
+    ) -> bytearray:
+        """Overwrite `buffer`, which must be master_node_size long, with the
+        binary representation of this MasterNode, starting with its CRC, and
+        return it for writing"""
 
-        stream = BytesStream()
-
-        stream.write(
-            MasterNode.struct.pack(
-                self.serial_number,
-                self.file_limit,
-                len(self.compression_block_contents),
-            )
+        # The CRC at the start is filled in once the rest is known
+        offset = MasterNode.crc_struct.size
+        MasterNode.struct.pack_into(
+            buffer,
+            offset,
+            self.serial_number,
+            self.file_limit,
+            len(self.compression_block_contents),
         )
+        offset += MasterNode.struct.size
 
-        self.metadata_pointer.write_data_coordinate(stream)
-        self.rightmost_path.write_rightmost_nodes(stream)
-        assert (
-            stream.tell() <= config.page_size - 4
-        ), "Too many RightmostNodes to fit on a page."
+        DataCoordinates.struct.pack_into(buffer, offset, *self.metadata_pointer)
+        offset += DataCoordinates.struct.size
+
+        offset = self.rightmost_path.write_rightmost_nodes_into(buffer, offset)
+        assert offset <= config.page_size, "Too many RightmostNodes to fit on a page."
 
         # Align to page
-        stream.zero_fill_to(config.page_size - 4)
+        buffer[offset : config.page_size] = zero_bytes(config.page_size - offset)
+        offset = config.page_size
+
+        end = offset + len(self.contents_of_last_page)
+        buffer[offset:end] = self.contents_of_last_page
+        offset = end
 
-        stream.write(self.contents_of_last_page)
-        stream.write(self.compression_block_contents)
+        end = offset + len(self.compression_block_contents)
+        buffer[offset:end] = self.compression_block_contents
+        offset = end
 
-        stream.zero_fill_to(config.master_node_size - 4)
-        return stream.getvalue()
+        buffer[offset:] = zero_bytes(config.master_node_size - offset)
+
+        MasterNode.crc_struct.pack_into(
+            buffer, 0, crc32(memoryview(buffer)[MasterNode.crc_struct.size :])
+        )
+        return buffer
 
 
 @dataclass
@@ -1192,16 +1789,27 @@ class RightmostPath:
                 total_number_of_children,
             ) = RightmostPath.number_of_children_struct.unpack_from(buffer, offset)
             offset += RightmostPath.number_of_children_struct.size
-            for _ in range(total_number_of_children):
-                # each child is preceded by its RightmostNode's height in the
-                # tree so the same height will be repeated for each of that
-                # RightmostNode's children
-                (
-                    height,
-                    data_coordinate,
-                ) = DataCoordinates.from_bytes_with_height_prefix(buffer, offset)
-                offset += DataCoordinates.height_prefix_struct.size
-                self.rightmost_node(height).add_child(data_coordinate)
+            end = (
+                offset
+                + total_number_of_children * DataCoordinates.height_prefix_struct.size
+            )
+            # each child is preceded by its RightmostNode's height in the tree so
+            # the same height will be repeated for each of that RightmostNode's
+            # children. The RightmostNode is only looked up when the height
+            # changes.
+            current_height = 0
+            children: List[DataCoordinates] = []
+            for (
+                height,
+                compressed_block_start,
+                data_start,
+            ) in DataCoordinates.height_prefix_struct.iter_unpack(
+                memoryview(buffer)[offset:end]
+            ):
+                if height != current_height:
+                    current_height = height
+                    children = self.rightmost_node(height).children
+                children.append(DataCoordinates(compressed_block_start, data_start))
 
     def rightmost_node(self, height: int, /) -> "RightmostNode":
         """Return the RightmostNode for the passed height.
@@ -1223,6 +1831,19 @@ class RightmostPath:
             )
         return self.rightmost_nodes[height - 1]
 
+    def snapshot(self, /) -> "RightmostPath":
+        """Return a copy of this RightmostPath that is unaffected by any
+        children added to it later.
+
+        Only the lists of children need to be copied since the DataCoordinates
+        they hold are immutable."""
+
+        rightmost_path = RightmostPath()
+        rightmost_path.rightmost_nodes = [
+            rightmost_node.snapshot() for rightmost_node in self.rightmost_nodes
+        ]
+        return rightmost_path
+
     def compute_record_count(self, fan_out: int, /) -> int:
         power = 1
         record_count = 0
@@ -1248,10 +1869,14 @@ class RightmostPath:
         capture_file: CaptureFile,
         /,
     ):
-        destination_rightmost_node = self.rightmost_node(rightmost_node_height)
-        destination_rightmost_node.add_child(child_coordinates)
+        fan_out = capture_file._fan_out
+        while True:
+            destination_rightmost_node = self.rightmost_node(rightmost_node_height)
+            destination_rightmost_node.add_child(child_coordinates)
+
+            if not destination_rightmost_node.is_full(fan_out):
+                return
 
-        if destination_rightmost_node.is_full(capture_file._config.fan_out):
             coordinates_where_full_node_is_written = (
                 capture_file._coordinates_for_next_new_data_block()
             )
@@ -1266,20 +1891,23 @@ class RightmostPath:
             # Since the result of adding a child to the provided RightmostNode
             # caused the RightmostNode to become full and written, we now need
             # to add the full node that was written as a child to it's parent
-            self.add_child_to_rightmost_node(
-                coordinates_where_full_node_is_written,
-                rightmost_node_height + 1,
-                capture_file,
-            )
+            child_coordinates = coordinates_where_full_node_is_written
+            rightmost_node_height += 1
+
+    def write_rightmost_nodes_into(self, buffer: bytearray, offset: int, /) -> int:
+        """Pack the rightmost nodes into `buffer` at `offset` and return the
+        offset just past them"""
 
-    def write_rightmost_nodes(self, stream: "BytesStream", /):
-        stream.write_long(self.decendant_count())
+        RightmostPath.number_of_children_struct.pack_into(
+            buffer, offset, self.decendant_count()
+        )
+        offset += RightmostPath.number_of_children_struct.size
         for height, rightmost_node in enumerate(self.rightmost_nodes, start=1):
             # height number starts at 1 not 0 like python lists
-            rightmost_node.write_with_height(stream, height)
+            offset = rightmost_node.write_with_height_into(buffer, offset, height)
+        return offset
 
 
-@dataclass
 class RightmostNode:
     """This is the rightmost node of a level in the tree index of all records
     and is not referred to by any parent node.
@@ -1299,30 +1927,53 @@ class RightmostNode:
 
     After a full RightmostNode is written, it is cleared of its children (reset)
     and ready to be filled again.
+
+    Its children are used on every record added and every record read through
+    the rightmost path so it is a plain class with __slots__ rather than a
+    dataclass.
     """
 
-    children: List["DataCoordinates"] = field(default_factory=list, init=False)
+    __slots__ = ("children",)
+
+    children: List["DataCoordinates"]
+
+    def __init__(self, /):
+        self.children = []
+
+    def __repr__(self, /) -> str:
+        return f"RightmostNode(children={self.children!r})"
 
     def add_child(self, data_coordinate: "DataCoordinates", /):
         self.children.append(data_coordinate)
 
-    def is_full(self, fan_out, /) -> bool:
+    def is_full(self, fan_out: int, /) -> bool:
         return len(self.children) == fan_out
 
-    def write_with_height(self, stream: "BytesStream", height: int, /):
-        """Output to stream in the form for storage in the MasterNode section of the
-        capture file"""
+    def write_with_height_into(
+        self, buffer: bytearray, offset: int, height: int, /
+    ) -> int:
+        """Pack into buffer at offset in the form for storage in the MasterNode
+        section of the capture file and return the offset just past it"""
 
+        pack_into = DataCoordinates.height_prefix_struct.pack_into
+        size = DataCoordinates.height_prefix_struct.size
         for data_coordinate in self.children:
-            stream.write_byte(height)
-            data_coordinate.write_data_coordinate(stream)
+            pack_into(buffer, offset, height, *data_coordinate)
+            offset += size
+        return offset
 
     def write_without_height(self, stream: "BytesStream", /):
         """Output to stream in the form for storage in the data section of the
         capture file"""
 
-        for data_coordinate in self.children:
-            data_coordinate.write_data_coordinate(stream)
+        stream.write(b"".join(starmap(DataCoordinates.struct.pack, self.children)))
+
+    def snapshot(self, /) -> "RightmostNode":
+        """Return a copy of this RightmostNode with its own list of children"""
+
+        rightmost_node = RightmostNode()
+        rightmost_node.children = self.children.copy()
+        return rightmost_node
 
     def reset(self, /):
         """Clear out the children making this an empty RightmostNode"""
@@ -1333,23 +1984,26 @@ class RightmostNode:
         return len(self.children)
 
 
-@dataclass(frozen=True)
-class DataCoordinates:
+class DataCoordinates(NamedTuple):
     """The two-dimensional coordinates of data within a capture file.
 
     The first axis is the absolute position within the capture file of the
     compressed block containing the data.
 
     The second axis is the position of the data within the uncompressed
-    block."""
+    block.
 
-    struct: ClassVar[Struct] = Struct(">QL")
+    One is created for every child of every index node that is read so it is
+    a NamedTuple to keep it small and cheap to create. The class attributes
+    below are not annotated because NamedTuple would treat them as fields."""
+
+    struct = Struct(">QL")
     """Big-endian unsigned long-long, unsigned long ">QL" """
 
-    height_prefix_struct: ClassVar[Struct] = Struct(">BQL")
+    height_prefix_struct = Struct(">BQL")
     """Big-endian unsigned char, unsigned long-long, unsigned long ">BQL" """
 
-    block_size_struct: ClassVar[Struct] = Struct(">L")
+    block_size_struct = Struct(">L")
     """Big-endian unsigned long ">L" """
 
     compressed_block_start: int
@@ -1363,32 +2017,10 @@ class DataCoordinates:
     def from_bytes(cls, block: bytes, offset: int, /) -> "DataCoordinates":
         return cls(*cls.struct.unpack_from(block, offset))
 
-    @classmethod
-    def from_bytes_with_height_prefix(
-        cls, block: bytes, offset: int, /
-    ) -> Tuple[int, "DataCoordinates"]:
-        (
-            height,
-            compressed_block_start,
-            data_start,
-        ) = cls.height_prefix_struct.unpack_from(block, offset)
-        return (
-            height,
-            cls(
-                compressed_block_start,
-                data_start,
-            ),
-        )
-
     @classmethod
     def null(cls, /) -> "DataCoordinates":
         return cls(0, 0)
 
-    def write_data_coordinate(self, stream: "BytesStream", /):
-        stream.write(
-            DataCoordinates.struct.pack(self.compressed_block_start, self.data_start)
-        )
-
     def is_null(self, /) -> bool:
         return self.compressed_block_start == 0 and self.data_start == 0
 
@@ -1411,40 +2043,88 @@ class DataCoordinates:
         )
 
 
-class BytesStream(BytesIO):
+class BytesStream:
+    """A binary stream backed by a bytearray.
+
+    Writes always append to the end of the data, which is all the capture file
+    needs, so the write position is simply the length of the data. The data
+    can be accessed without copying through `getbuffer`.
+
+    The `next...` methods read sequentially from the start of the data."""
+
+    __slots__ = ("_buffer", "_read_position")
+
+    byte_struct: ClassVar[Struct] = Struct(">B")
+    """Big-endian unsigned char ">B" """
+
+    long_struct: ClassVar[Struct] = Struct(">L")
+    """Big-endian unsigned long ">L" """
+
+    long_long_struct: ClassVar[Struct] = Struct(">Q")
+    """Big-endian unsigned long-long ">Q" """
+
+    def __init__(self, initial_bytes: bytes = b"", /):
+        self._buffer = bytearray(initial_bytes)
+        self._read_position = 0
+
+    def write(self, data: bytes, /):
+        self._buffer += data
+
+    def tell(self, /) -> int:
+        return len(self._buffer)
+
+    def getvalue(self, /) -> bytes:
+        return bytes(self._buffer)
+
+    def getbuffer(self, /) -> memoryview:
+        return memoryview(self._buffer)
+
+    def clear(self, /):
+        """Discard all of the data so that the stream can be reused"""
+
+        del self._buffer[:]
+        self._read_position = 0
+
+    def read(self, size: int, /) -> bytes:
+        start = self._read_position
+        self._read_position = min(start + size, len(self._buffer))
+        return bytes(self._buffer[start : self._read_position])
+
+    def _next_unpacked(self, struct: Struct, /) -> int:
+        (integer,) = struct.unpack_from(self._buffer, self._read_position)
+        self._read_position += struct.size
+        return integer
+
     def next_long(self, /) -> int:
-        return int.from_bytes(self.read(4), "big", signed=False)
+        return self._next_unpacked(BytesStream.long_struct)
 
     def next_long_long(self, /) -> int:
-        return int.from_bytes(self.read(8), "big", signed=False)
+        return self._next_unpacked(BytesStream.long_long_struct)
 
     def next(self, /) -> int:
-        return int.from_bytes(self.read(1), "big", signed=False)
+        return self._next_unpacked(BytesStream.byte_struct)
 
     def next_sized(self, /) -> bytes:
         size = self.next_long()
         return self.read(size)
 
     def write_sized(self, data: bytes, /):
-        size = len(data)
-        size_bytes = int.to_bytes(size, 4, "big", signed=False)
-        self.write(size_bytes)
-        self.write(data)
+        self._buffer += BytesStream.long_struct.pack(len(data))
+        self._buffer += data
 
     def write_byte(self, integer: int, /):
-        int_as_bytes = int.to_bytes(integer, 1, "big", signed=False)
-        self.write(int_as_bytes)
+        self._buffer += BytesStream.byte_struct.pack(integer)
 
     def write_long(self, integer: int, /):
-        int_as_bytes = int.to_bytes(integer, 4, "big", signed=False)
-        self.write(int_as_bytes)
+        self._buffer += BytesStream.long_struct.pack(integer)
 
     def write_long_long(self, integer: int, /):
-        int_as_bytes = int.to_bytes(integer, 8, "big", signed=False)
-        self.write(int_as_bytes)
+        self._buffer += BytesStream.long_long_struct.pack(integer)
 
     def zero_fill_to(self, end_position: int, /):
-        self.write(b"\0" * (end_position - self.tell()))
+        size = end_position - len(self._buffer)
+        if size > 0:
+            self._buffer += zero_bytes(size)
 
 
 @dataclass
@@ -1469,17 +2149,39 @@ class ReferenceCountedLock:
             self._lock.release()
 
 
-def leaf_to_root_path(position: int, height: int, fan_out: int, /) -> List[int]:
-    """Compute the path of child indexes from the leaf through the nodes to the
-    root."""
+def root_to_leaf_path(
+    position: int, height: int, fan_out: int, fan_out_shift: Optional[int] = None, /
+) -> List[int]:
+    """Compute the path of child indexes from the root through the nodes to the
+    leaf.
+
+    If fan_out is a power of two, passing its log2 as fan_out_shift computes
+    the path with shifts and masks instead of divisions."""
 
     path = [0] * height
-    for i in range(height):
-        position, path[i] = divmod(position, fan_out)
+    if fan_out_shift is None:
+        for i in range(height - 1, -1, -1):
+            position, path[i] = divmod(position, fan_out)
+    else:
+        mask = fan_out - 1
+        for i in range(height - 1, -1, -1):
+            path[i] = position & mask
+            position >>= fan_out_shift
 
     return path
 
 
+_zeros = memoryview(bytes(65536))
+"""Shared zero bytes that are sliced by zero_bytes"""
+
+
+def zero_bytes(size: int, /) -> Union[memoryview, bytes]:
+    """Return `size` zero bytes for padding without allocating them when they
+    fit within the shared zero bytes."""
+
+    return _zeros[:size] if size <= len(_zeros) else bytes(size)
+
+
 class CaptureFileAlreadyOpen(Exception):
     pass
 
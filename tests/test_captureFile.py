@@ -1,26 +1,43 @@
 import logging
+import shutil
+import sys
 import time
 
-from multiprocessing import Process
+from itertools import islice
+from multiprocessing import Event, Pipe, Process
 from pathlib import Path
 from threading import Thread
 
-from CaptureFile import CaptureFile, CaptureFileAlreadyOpen
+import pytest
+
+from CaptureFile import (
+    CaptureFile,
+    CaptureFileAlreadyOpen,
+    CaptureFileNotOpen,
+    InvalidCaptureFile,
+)
 
 LOGGER = logging.getLogger()
-file_name_1 = R"TempTestFiles/new_capture_file_py.capture"
-file_name_2 = R"TempTestFiles/add_after_open.capture"
+slow = pytest.mark.slow
+
+
+def throughput(number_of_records: int, elapsed_ns: int) -> str:
+    return (
+        f"{elapsed_ns / 1e9}s, {elapsed_ns / number_of_records:.0f} ns/record,"
+        f" {number_of_records * 1e9 / elapsed_ns:,.0f} records/s"
+    )
 
 
-def test_new_file():
-    pass
-    cf = CaptureFile(file_name_1, to_write=True, force_new_empty_file=True)
+def test_new_file(tmp_path):
+    file_name = str(tmp_path / "new_file.capture")
+    cf = CaptureFile(file_name, to_write=True, force_new_empty_file=True)
     assert cf.record_count() == 0
     cf.close()
 
 
-def test_str():
-    with CaptureFile(file_name_1, to_write=True, force_new_empty_file=True) as cf:
+def test_str(tmp_path):
+    file_name = str(tmp_path / "str.capture")
+    with CaptureFile(file_name, to_write=True, force_new_empty_file=True) as cf:
         for i in range(1, 10001):
             cf.add_record(f"Hey this is my record {i:,}")
         LOGGER.info(str(cf))
@@ -30,43 +47,33 @@ def test_str():
         LOGGER.info(str(cf))
 
 
-def test_record_out_of_range():
-    cf = CaptureFile(file_name_1, to_write=True, force_new_empty_file=True)
-    try:
-        cf.record_at(0)
-    except IndexError:
-        LOGGER.info(
-            "Got expected index error because you cannot get a record number < 1"
-        )
-    else:
-        cf.close()
-        assert False, "Should not be able to get a record number < 1"
-
+def test_record_out_of_range(tmp_path):
+    file_name = str(tmp_path / "record_out_of_range.capture")
+    cf = CaptureFile(file_name, to_write=True, force_new_empty_file=True)
     try:
-        cf.record_at(1)
-    except IndexError:
-        LOGGER.info(
-            "Got expected index error because you cannot get a record number > record"
-            " count"
-        )
-    else:
+        # You cannot get a record number < 1
+        with pytest.raises(IndexError):
+            cf.record_at(0)
+        # You cannot get a record number that hasn't been added
+        with pytest.raises(IndexError):
+            cf.record_at(1)
+    finally:
         cf.close()
-        assert False, "Should not be able to get a record number that hasn't been added"
-
-    cf.close()
 
 
-def test_setting_and_getting_metadata():
-    cf = CaptureFile(file_name_1, to_write=True)
+def test_setting_and_getting_metadata(tmp_path):
+    file_name = str(tmp_path / "metadata.capture")
+    cf = CaptureFile(file_name, to_write=True)
     cf.set_metadata(b"One more metadata update3")
     assert b"One more metadata update3" == cf.get_metadata()
     cf.commit()
     cf.close()
 
 
-def test_setting_metadata_and_adding_records():
+def test_setting_metadata_and_adding_records(tmp_path):
+    file_name = str(tmp_path / "metadata.capture")
     cf = CaptureFile(
-        file_name_1,
+        file_name,
         to_write=True,
         initial_metadata=b"This is the initial metadata",
         force_new_empty_file=True,
@@ -74,10 +81,11 @@ def test_setting_metadata_and_adding_records():
     assert b"This is the initial metadata" == cf.get_metadata()
     cf.set_metadata(b"Yo, this is my special metadata stuff")
     assert b"Yo, this is my special metadata stuff" == cf.get_metadata()
-    for i in range(1, 10001):
-        cf.add_record(f"Hey this is my record {i:,}")
-        if i % 100 == 0:
-            cf.commit()
+    for first in range(1, 10001, 100):
+        cf.add_records(
+            f"Hey this is my record {i:,}" for i in range(first, first + 100)
+        )
+        cf.commit()
     assert b"Yo, this is my special metadata stuff" == cf.get_metadata()
     cf.set_metadata(b"No, way yo, this is my real special metadata stuff")
     cf.add_record(f"Hey this is my record {10001:,}")
@@ -90,237 +98,531 @@ def test_setting_metadata_and_adding_records():
     cf.close()
 
 
-def test_adding_10_000_string_records():
-    start = time.time()
+def test_setting_unchanged_metadata(tmp_path):
+    cf = CaptureFile(
+        str(tmp_path / "metadata.capture"),
+        to_write=True,
+        initial_metadata=b"checkpoint 1",
+        force_new_empty_file=True,
+    )
+    metadata_pointer = cf._current_master_node.metadata_pointer
+    cf.set_metadata(b"checkpoint 1")
+    # The same metadata is not stored again
+    assert cf._current_master_node.metadata_pointer == metadata_pointer
+    cf.close()
+
+
+def test_setting_metadata_from_a_changed_buffer(tmp_path):
+    file_name = str(tmp_path / "metadata.capture")
+    cf = CaptureFile(file_name, to_write=True, force_new_empty_file=True)
+    checkpoint = bytearray(b"checkpoint 1")
+    cf.set_metadata(checkpoint)
+    cf.commit()
+    checkpoint[-1:] = b"2"
+    cf.set_metadata(checkpoint)
+    cf.commit()
+    cf.close()
+    cf = CaptureFile(file_name)
+    assert cf.get_metadata() == b"checkpoint 2"
+    cf.close()
+
+
+@pytest.fixture(scope="session")
+def capture_file_with_10_000_records(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp("capture") / "10_000.capture")
+    start = time.perf_counter_ns()
     number_of_records = 10_000
     cf = CaptureFile(
-        file_name_1,
+        file_name,
         to_write=True,
         initial_metadata=b"This is the initial metadata",
         force_new_empty_file=True,
     )
-    for i in range(1, number_of_records + 1):
-        cf.add_record(f"Hey this is my record {i:,}")
-        if i % 1000 == 0:
-            cf.commit()
-    cf.commit()
-    assert cf.record_count() == number_of_records
-    end = time.time()
+    for first in range(1, number_of_records + 1, 1000):
+        cf.add_records(
+            f"Hey this is my record {i:,}" for i in range(first, first + 1000)
+        )
+        cf.commit()
+    end = time.perf_counter_ns()
+    cf.close()
+    LOGGER.info(
+        f"Elapsed time writing {number_of_records:,} records ="
+        f" {throughput(number_of_records, end - start)}"
+    )
+    return file_name
+
+
+def test_adding_10_000_string_records(capture_file_with_10_000_records):
+    cf = CaptureFile(capture_file_with_10_000_records)
+    assert cf.record_count() == 10_000
+    assert cf.get_metadata() == b"This is the initial metadata"
     LOGGER.info(f"There are {cf.record_count():,} records in this file")
     cf.close()
-    LOGGER.info(f"Elapsed time writing {number_of_records:,} records = {end-start}s")
 
 
-def test_10_000_string_record_contents_using_record_at():
-    start = time.time()
+def test_10_000_string_record_contents_using_record_at(
+    capture_file_with_10_000_records,
+):
     number_of_records = 10_000
-    cf = CaptureFile(file_name_1)
-    for i in range(1, number_of_records + 1):
-        record = cf.record_at(i)
-        assert record == f"Hey this is my record {i:,}"
+    expected_records = [
+        f"Hey this is my record {i:,}" for i in range(1, number_of_records + 1)
+    ]
+    start = time.perf_counter_ns()
+    cf = CaptureFile(capture_file_with_10_000_records)
+    records = [cf.record_at(i) for i in range(1, number_of_records + 1)]
+    assert records == expected_records
     cf.close()
-    end = time.time()
+    end = time.perf_counter_ns()
     LOGGER.info(
         f"Elapsed time reading and validating {number_of_records:,} records using"
-        f" record_at = {end-start}s"
+        f" record_at = {throughput(number_of_records, end - start)}"
     )
 
 
-def test_adding_10_000_000_string_records():
-    start = time.time()
+@pytest.fixture(scope="session")
+def capture_file_with_10_000_000_records(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp("capture") / "10_000_000.capture")
     number_of_records = 10_000_000
+    prefix = b"Hey this is my record "
+    elapsed = 0
     cf = CaptureFile(
-        file_name_1,
+        file_name,
         to_write=True,
         initial_metadata=b"This is the initial metadata",
         force_new_empty_file=True,
     )
-    for i in range(1, number_of_records + 1):
-        cf.add_record(f"Hey this is my record {i:,}")
-        if i % 1_000 == 0:
-            cf.commit()
-    cf.commit()
-    assert cf.record_count() == number_of_records
-    end = time.time()
+    for first in range(1, number_of_records + 1, 1_000_000):
+        # Format each batch before timing it so only the writes are measured
+        records = [prefix + f"{i:,}".encode() for i in range(first, first + 1_000_000)]
+        start = time.perf_counter_ns()
+        cf.add_records(records)
+        cf.commit()
+        elapsed += time.perf_counter_ns() - start
+    cf.close()
+    LOGGER.info(
+        f"Elapsed time writing {number_of_records:,} records ="
+        f" {throughput(number_of_records, elapsed)}"
+    )
+    return file_name
+
+
+@slow
+def test_adding_10_000_000_string_records(capture_file_with_10_000_000_records):
+    cf = CaptureFile(capture_file_with_10_000_000_records)
+    assert cf.record_count() == 10_000_000
     LOGGER.info(f"There are {cf.record_count():,} records in this file")
     cf.close()
-    LOGGER.info(f"Elapsed time writing {number_of_records:,} records = {end-start}s")
 
 
-def test_10_000_000_record_contents_using_record_at():
-    start = time.time()
+@slow
+def test_10_000_000_record_contents_using_record_generator(
+    capture_file_with_10_000_000_records,
+):
+    start = time.perf_counter_ns()
     number_of_records = 10_000_000
-    cf = CaptureFile(file_name_1)
-    for i in range(1, number_of_records + 1):
-        record = cf.record_at(i)
-        assert record == f"Hey this is my record {i:,}"
+    cf = CaptureFile(capture_file_with_10_000_000_records)
+    rg = cf.record_generator(1)
+    # Compare a million records at a time to keep memory use bounded
+    for first in range(1, number_of_records + 1, 1_000_000):
+        assert list(islice(rg, 1_000_000)) == [
+            f"Hey this is my record {i:,}" for i in range(first, first + 1_000_000)
+        ]
+    assert next(rg, None) is None
     cf.close()
-    end = time.time()
+    end = time.perf_counter_ns()
     LOGGER.info(
         f"Elapsed time reading and validating {number_of_records:,} records using"
-        f" record_at = {end-start}s"
+        f" record_generator = {throughput(number_of_records, end - start)}"
     )
 
 
-def test_adding_records_after_closing_and_opening_again():
-    cf = CaptureFile(file_name_2, to_write=True, force_new_empty_file=True)
-    for i in range(1, 101):
+def test_adding_records_after_closing_and_opening_again(
+    tmp_path, capture_file_with_10_000_records
+):
+    # Copying the prepared file is much cheaper than adding its records again
+    file_name = str(tmp_path / "add_after_open.capture")
+    shutil.copyfile(capture_file_with_10_000_records, file_name)
+    cf = CaptureFile(file_name, to_write=True)
+    for i in range(10_001, 10_101):
         cf.add_record(f"Hey this is my record {i:,}")
     cf.commit()
+    assert cf.record_count() == 10_100
+    cf.close()
+    cf = CaptureFile(file_name)
+    assert [cf.record_at(i) for i in range(1, 10_101)] == [
+        f"Hey this is my record {i:,}" for i in range(1, 10_101)
+    ]
+    cf.close()
+
+
+def test_getting_slices_with_a_step(capture_file_with_10_000_records):
+    cf = CaptureFile(capture_file_with_10_000_records)
+    assert cf[1:200:7] == [f"Hey this is my record {i:,}" for i in range(1, 200, 7)]
+    assert cf[150:3:-4] == [f"Hey this is my record {i:,}" for i in range(150, 3, -4)]
     cf.close()
-    cf = CaptureFile(file_name_2, to_write=True)
-    for i in range(101, 201):
+
+
+def test_zstd_compression(tmp_path):
+    pytest.importorskip("zstandard")
+    file_name = str(tmp_path / "zstd.capture")
+    cf = CaptureFile(
+        file_name, to_write=True, force_new_empty_file=True, compression="zstd"
+    )
+    for i in range(1, 10_001):
         cf.add_record(f"Hey this is my record {i:,}")
+        if i % 1000 == 0:
+            cf.commit()
+    cf.close()
+    cf = CaptureFile(file_name)
+    assert cf.record_count() == 10_000
+    assert list(cf) == [f"Hey this is my record {i:,}" for i in range(1, 10_001)]
+    cf.close()
+
+
+def test_adding_records_in_batches(tmp_path):
+    file_name = str(tmp_path / "add_records.capture")
+    cf = CaptureFile(file_name, to_write=True, force_new_empty_file=True)
+    for first in range(1, 10_001, 1000):
+        record_count = cf.add_records(
+            f"Hey this is my record {i:,}" for i in range(first, first + 1000)
+        )
+        cf.commit()
+        assert record_count == first + 999
+    cf.close()
+    cf = CaptureFile(file_name)
+    assert cf.record_count() == 10_000
+    assert [cf.record_at(i) for i in range(1, 10_001)] == [
+        f"Hey this is my record {i:,}" for i in range(1, 10_001)
+    ]
+    cf.close()
+
+
+def test_adding_str_and_bytes_records(tmp_path):
+    file_name = str(tmp_path / "add_records.capture")
+    cf = CaptureFile(file_name, to_write=True, force_new_empty_file=True)
+    assert cf.add_str_record("Hey this is my record 1") == 1
+    assert cf.add_bytes_record(b"Hey this is my record 2") == 2
+    cf.commit()
+    assert cf[1:3] == ["Hey this is my record 1", "Hey this is my record 2"]
+    cf.close()
+
+
+def test_compression_level(tmp_path):
+    file_limits = {}
+    for level in (0, 9):
+        file_name = str(tmp_path / f"compression_level_{level}.capture")
+        cf = CaptureFile(
+            file_name, to_write=True, force_new_empty_file=True, compression_level=level
+        )
+        cf.add_records(f"Hey this is my record {i:,}" for i in range(1, 10_001))
+        cf.commit()
+        file_limits[level] = cf._current_master_node.file_limit
+        cf.close()
+        cf = CaptureFile(file_name)
+        assert list(cf) == [f"Hey this is my record {i:,}" for i in range(1, 10_001)]
+        cf.close()
+    # Level 0 stores the blocks without compressing them
+    assert file_limits[9] * 3 < file_limits[0]
+
+
+def test_invalid_compression_level(tmp_path):
+    file_name = str(tmp_path / "compression_level.capture")
+    with pytest.raises(ValueError):
+        CaptureFile(
+            file_name, to_write=True, force_new_empty_file=True, compression_level=42
+        )
+    assert not Path(file_name).exists()
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    with pytest.raises(ValueError):
+        CaptureFile(file_name, to_write=True, compression_level=42)
+    # The failed open did not leave the file open for write
+    CaptureFile(file_name, to_write=True, compression_level=9).close()
+
+
+def test_invalid_zstd_compression_level(tmp_path):
+    zstandard = pytest.importorskip("zstandard")
+    file_name = str(tmp_path / "zstd.capture")
+    with pytest.raises(ValueError):
+        CaptureFile(
+            file_name,
+            to_write=True,
+            force_new_empty_file=True,
+            compression="zstd",
+            compression_level=zstandard.MAX_COMPRESSION_LEVEL + 1,
+        )
+
+
+def test_block_cache_size(tmp_path):
+    file_name = str(tmp_path / "block_cache_size.capture")
+    CaptureFile(
+        file_name, to_write=True, force_new_empty_file=True, compression_block_size=4096
+    ).close()
+    cf = CaptureFile(file_name, block_cache_size=10 * 4096)
+    assert cf._block_cache.cache_info().maxsize == 10
+    assert cf._full_node_cache.cache_info().maxsize == 10
+    cf.close()
+    # A cache smaller than one block still holds one block
+    cf = CaptureFile(file_name, block_cache_size=1)
+    assert cf._block_cache.cache_info().maxsize == 1
+    assert cf._full_node_cache.cache_info().maxsize == 1
+    cf.close()
+
+
+def failing_refresh(monkeypatch, failures: int):
+    """Make refresh fail `failures` times before it succeeds and return the
+    list the retry delays are recorded in"""
+
+    refresh = CaptureFile._CaptureFile__refresh
+    remaining = [failures]
+
+    def flaky_refresh(self):
+        if remaining[0] > 0:
+            remaining[0] -= 1
+            raise InvalidCaptureFile("Master nodes are not consecutive")
+        refresh(self)
+
+    delays = []
+    monkeypatch.setattr(CaptureFile, "_CaptureFile__refresh", flaky_refresh)
+    monkeypatch.setattr(sys.modules[CaptureFile.__module__], "sleep", delays.append)
+    return delays
+
+
+def test_refresh_retries(tmp_path, monkeypatch):
+    file_name = str(tmp_path / "refresh.capture")
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    cf = CaptureFile(file_name)
+    delays = failing_refresh(monkeypatch, 3)
+    cf.refresh()
+    assert delays == list(CaptureFile._refresh_retry_delays[:3])
+    assert cf.record_count() == 0
+    cf.close()
+
+
+def test_refresh_raises_the_last_failure(tmp_path, monkeypatch):
+    file_name = str(tmp_path / "refresh.capture")
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    cf = CaptureFile(file_name)
+    # Every retry fails and so does the final attempt after them
+    delays = failing_refresh(monkeypatch, len(CaptureFile._refresh_retry_delays) + 1)
+    with pytest.raises(InvalidCaptureFile):
+        cf.refresh()
+    assert delays == list(CaptureFile._refresh_retry_delays)
+    # A failed refresh closes the capture file
+    with pytest.raises(CaptureFileNotOpen):
+        cf.refresh()
+
+
+def test_sequential_prefetch(tmp_path, monkeypatch):
+    module = sys.modules[CaptureFile.__module__]
+    if module.posix_fadvise is None:
+        pytest.skip("posix_fadvise is not available on this OS")
+    posix_fadvise = module.posix_fadvise
+    advice = []
+
+    def recording_posix_fadvise(fd, offset, length, advice_type):
+        advice.append((offset, length, advice_type))
+        posix_fadvise(fd, offset, length, advice_type)
+
+    monkeypatch.setattr(module, "posix_fadvise", recording_posix_fadvise)
+    file_name = str(tmp_path / "prefetch.capture")
+    cf = CaptureFile(file_name, to_write=True, force_new_empty_file=True)
+    cf.add_records(f"Hey this is my record {i:,}" for i in range(1, 1001))
     cf.commit()
-    assert cf.record_count() == 200
     cf.close()
-    cf = CaptureFile(file_name_2)
-    for i in range(1, 201):
-        record = cf.record_at(i)
-        assert record == f"Hey this is my record {i:,}"
+    cf = CaptureFile(file_name, prefetch="sequential")
+    assert advice == [(0, 0, module.POSIX_FADV_SEQUENTIAL)]
+    assert list(cf) == [f"Hey this is my record {i:,}" for i in range(1, 1001)]
+    cf.close()
+
+
+def test_unsupported_prefetch(tmp_path):
+    file_name = str(tmp_path / "prefetch.capture")
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    with pytest.raises(ValueError):
+        CaptureFile(file_name, prefetch="random")
+
+
+@pytest.mark.parametrize("version", [0, 4])
+def test_unsupported_version(tmp_path, monkeypatch, version: int):
+    file_name = str(tmp_path / "version.capture")
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    with open(file_name, "r+b") as file:
+        file.seek(len(b"MioCapture\0"))
+        file.write(version.to_bytes(4, byteorder="big"))
+    # Even a version the code claims to support needs a known compression
+    configuration = sys.modules[CaptureFile.__module__].CaptureFileConfiguration
+    monkeypatch.setattr(configuration, "current_version", 4)
+    with pytest.raises(InvalidCaptureFile):
+        CaptureFile(file_name)
+
+
+def test_short_read_does_not_leave_stale_bytes(tmp_path):
+    file_name = str(tmp_path / "short_read.capture")
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    file_size = Path(file_name).stat().st_size
+    cf = CaptureFile(file_name)
+    buffer = bytearray(b"stale bytes")
+    assert cf._read_into_at(file_size - 4, memoryview(buffer)) == 4
+    assert buffer[4:] == bytes(len(buffer) - 4)
     cf.close()
 
 
-def lock_file_for_a_time():
+def lock_file_for_a_time(file_name: str, conn):
     print("Starting lock_file_for_a_time")
     LOGGER.info("Starting lock_file_for_a_time")
-    cf = CaptureFile(file_name_1, to_write=True, use_os_file_locking=True)
+    cf = CaptureFile(file_name, to_write=True, use_os_file_locking=True)
     print("Done")
     LOGGER.info("Done")
-    time.sleep(500)
+    conn.send("ready")
+    # Hold the file open until the test is done with it
+    conn.recv()
     cf.close()
 
 
-def test_trying_to_open_for_write_twice_different_process():
-    p = Process(target=lock_file_for_a_time)
+def test_trying_to_open_for_write_twice_different_process(tmp_path):
+    file_name = str(tmp_path / "open_twice.capture")
+    parent_conn, child_conn = Pipe()
+    p = Process(target=lock_file_for_a_time, args=(file_name, child_conn))
     p.start()
-    time.sleep(1)
+    assert parent_conn.poll(10), "The other process never opened the file"
+    assert parent_conn.recv() == "ready"
     LOGGER.info("File opened for write in another process")
-    cfr = CaptureFile(file_name_1, use_os_file_locking=True)
+    cfr = CaptureFile(file_name, use_os_file_locking=True)
     LOGGER.info("File opened for read")
     try:
         LOGGER.info(
             f"Files opened for write -> \n{CaptureFile._filenames_opened_for_write}"
         )
-        cfw2 = CaptureFile(file_name_1, to_write=True, use_os_file_locking=True)
-        LOGGER.info("File opened for write - second time")
-    except CaptureFileAlreadyOpen:
-        LOGGER.info(
-            "Got expected error because you cannot open the same capture file twice for"
-            " write"
-        )
-    else:
-        cfw2.close()
-        assert False, "Should not be able to open the capture file twice"
-    p.kill()
+        # You cannot open the same capture file twice for write
+        with pytest.raises(CaptureFileAlreadyOpen):
+            CaptureFile(file_name, to_write=True, use_os_file_locking=True)
+    finally:
+        parent_conn.send("release")
+        p.join(timeout=10)
+        if p.is_alive():
+            p.kill()
+            p.join()
     cfr.close()
     LOGGER.info(
         f"Files opened for write -> \n{CaptureFile._filenames_opened_for_write}"
     )
 
 
-def test_trying_to_open_for_write_twice_same_process():
+def test_trying_to_open_for_write_twice_same_process(tmp_path):
+    file_name = str(tmp_path / "open_twice.capture")
     LOGGER.info(
         f"Files opened for write -> \n{CaptureFile._filenames_opened_for_write}"
     )
-    cfw1 = CaptureFile(file_name_1, to_write=True)
+    cfw1 = CaptureFile(file_name, to_write=True)
     LOGGER.info("File opened for write in another process")
-    cfr = CaptureFile(file_name_1)
+    cfr = CaptureFile(file_name)
     LOGGER.info("File opened for read")
     try:
-        cfw2 = CaptureFile(file_name_1, to_write=True)
-        LOGGER.info("File opened for write - second time")
-    except CaptureFileAlreadyOpen as ex:
-        LOGGER.info(
-            "Got expected error because you cannot open the same capture file twice for"
-            " write"
-        )
-    else:
-        cfw2.close()
-        assert False, "Should not be able to open the capture file twice"
-    cfw1.close()
-    cfr.close()
+        # You cannot open the same capture file twice for write
+        with pytest.raises(CaptureFileAlreadyOpen):
+            CaptureFile(file_name, to_write=True)
+    finally:
+        cfw1.close()
+        cfr.close()
 
 
-def lock_master_node_for_a_while(phase: int, use_os_file_locking: bool):
+def lock_master_node_for_a_while(
+    cf: CaptureFile, phase: int, locked=None, release=None
+):
     print(f"Starting lock_master_node_for_a_while - phase: {phase}")
     LOGGER.info(f"Starting lock_master_node_for_a_while - phase: {phase}")
-    cf = CaptureFile(file_name_1, use_os_file_locking=use_os_file_locking)
-    print(f"Capture file open - phase: {phase}")
-    LOGGER.info(f"Capture file open - phase: {phase}")
     cf._acquire_master_nodes_lock_internal(True)
     print(f"Lock acquired - phase: {phase}")
     LOGGER.info(f"Lock acquired - phase: {phase}")
-    time.sleep(2)
+    if locked is not None:
+        locked.set()
+    if release is not None:
+        release.wait()
     cf._acquire_master_nodes_lock_internal(False)
     print(f"Lock released - phase: {phase}")
     LOGGER.info(f"Lock released - phase: {phase}")
-    cf.close()
-
-
-def test_master_node_locking_1(use_os_file_locking: bool = False):
-    """Couldn't use paramerization because pytest did them in parallel"""
-    path = Path(file_name_1)
-    t1 = Thread(target=lock_master_node_for_a_while, args=(1, use_os_file_locking))
-    t1.start()
-    time.sleep(1)
-    print(CaptureFile._filenames_with_master_node_lock[path])
-    LOGGER.info(CaptureFile._filenames_with_master_node_lock[path])
-    t2 = Thread(target=lock_master_node_for_a_while, args=(2, use_os_file_locking))
-    t2.start()
-    time.sleep(6)
-    assert path not in CaptureFile._filenames_with_master_node_lock
-
-
-def test_master_node_locking_P1(use_os_file_locking: bool = False):
-    """Couldn't use paramerization because pytest did them in parallel"""
-    path = Path(file_name_1)
-    t1 = Process(target=lock_master_node_for_a_while, args=(1, use_os_file_locking))
-    t1.start()
-    time.sleep(1)
-    t2 = Thread(target=lock_master_node_for_a_while, args=(2, use_os_file_locking))
-    t2.start()
-    time.sleep(6)
-    assert path not in CaptureFile._filenames_with_master_node_lock
 
 
-def test_master_node_locking_2(use_os_file_locking: bool = True):
-    """Couldn't use paramerization because pytest did them in parallel"""
-    path = Path(file_name_1)
-    t1 = Thread(target=lock_master_node_for_a_while, args=(1, use_os_file_locking))
-    t1.start()
-    time.sleep(1)
-    print(CaptureFile._filenames_with_master_node_lock[path])
-    LOGGER.info(CaptureFile._filenames_with_master_node_lock[path])
-    t2 = Thread(target=lock_master_node_for_a_while, args=(2, use_os_file_locking))
-    t2.start()
-    time.sleep(6)
-    assert path not in CaptureFile._filenames_with_master_node_lock
+def open_and_lock_master_node_for_a_while(
+    file_name: str,
+    phase: int,
+    use_os_file_locking: bool,
+    locked=None,
+    release=None,
+    trying=None,
+):
+    if trying is not None:
+        # Opening refreshes the capture file which also takes the master node lock
+        trying.set()
+    cf = CaptureFile(file_name, use_os_file_locking=use_os_file_locking)
+    print(f"Capture file open - phase: {phase}")
+    LOGGER.info(f"Capture file open - phase: {phase}")
+    lock_master_node_for_a_while(cf, phase, locked, release)
+    cf.close()
 
 
-def test_master_node_locking_P2(use_os_file_locking: bool = True):
-    """Couldn't use paramerization because pytest did them in parallel"""
-    path = Path(file_name_1)
-    t1 = Process(target=lock_master_node_for_a_while, args=(1, use_os_file_locking))
+@pytest.mark.parametrize(
+    "use_os_file_locking,runner",
+    [(False, Thread), (True, Thread), (False, Process), (True, Process)],
+)
+def test_master_node_locking(tmp_path, use_os_file_locking: bool, runner):
+    """Each case locks its own capture file so the cases can run in parallel.
+    Each locker opens its own instance of the capture file so the in-process
+    master node lock is shared and reference counted between them."""
+    file_name = str(tmp_path / "master_node_locking.capture")
+    CaptureFile(file_name, to_write=True, force_new_empty_file=True).close()
+    path = Path(file_name)
+    locked = Event()
+    release = Event()
+    t1 = runner(
+        target=open_and_lock_master_node_for_a_while,
+        args=(file_name, 1, use_os_file_locking, locked, release),
+    )
     t1.start()
-    time.sleep(1)
-    t2 = Thread(target=lock_master_node_for_a_while, args=(2, use_os_file_locking))
-    t2.start()
-    time.sleep(6)
+    try:
+        assert locked.wait(timeout=10), "The first locker never acquired the lock"
+        trying = Event()
+        locked_2 = Event()
+        t2 = Thread(
+            target=open_and_lock_master_node_for_a_while,
+            args=(file_name, 2, use_os_file_locking, locked_2, None, trying),
+        )
+        t2.start()
+        assert trying.wait(timeout=10), "The second locker never tried for the lock"
+        if runner is Thread:
+            print(CaptureFile._filenames_with_master_node_lock[path])
+            LOGGER.info(CaptureFile._filenames_with_master_node_lock[path])
+            # The first thread still holds the lock so the second must wait for it
+            assert locked_2.wait(0.2) is False
+        else:
+            # The in-process lock is not shared with another process and readers
+            # only take shared OS locks, so this case only checks that a reader
+            # is not blocked by a reader in another process
+            assert locked_2.wait(timeout=10), "A reader was blocked by a reader"
+    finally:
+        # Never leave the first locker waiting if an assertion fails
+        release.set()
+    assert locked_2.wait(timeout=10), "The second locker never acquired the lock"
+    t1.join()
+    t2.join()
     assert path not in CaptureFile._filenames_with_master_node_lock
 
 
-def test_1_record_at_contents():
-    cf = CaptureFile(file_name_1)
+@slow
+def test_1_record_at_contents(capture_file_with_10_000_000_records):
+    cf = CaptureFile(capture_file_with_10_000_000_records)
     i = 999_638
     record = cf.record_at(i)
     assert record == f"Hey this is my record {i:,}"
     cf.close()
 
 
-def test_timing_of_iterator():
-    start = time.time()
-    cfr = CaptureFile(file_name_1, encoding=None)
+@slow
+def test_timing_of_iterator(capture_file_with_10_000_000_records):
+    start = time.perf_counter_ns()
+    cfr = CaptureFile(
+        capture_file_with_10_000_000_records, encoding=None, prefetch="sequential"
+    )
     number_of_records = 10_000_000
     start_record = 1
     # iter just calls record_generator
@@ -328,25 +630,31 @@ def test_timing_of_iterator():
     for _ in range(start_record, start_record + number_of_records):
         next(rg)
     cfr.close()
-    end = time.time()
+    end = time.perf_counter_ns()
     LOGGER.info(
         f"Elapsed time reading {number_of_records:,} records starting at record"
-        f" {start_record:,} = {end-start}s"
+        f" {start_record:,} = {throughput(number_of_records, end - start)}"
     )
 
 
-def test_record_generator_directly():
-    start = time.time()
-    cfr = CaptureFile(file_name_1)
+@slow
+def test_record_generator_directly(capture_file_with_10_000_000_records):
     number_of_records = 1_000_000
     start_record = 1
+    # Build the expected raw records before timing so only reading is measured
+    expected_records = [
+        f"Hey this is my record {i:,}".encode()
+        for i in range(start_record, start_record + number_of_records)
+    ]
+    start = time.perf_counter_ns()
+    cfr = CaptureFile(
+        capture_file_with_10_000_000_records, encoding=None, prefetch="sequential"
+    )
     rg = cfr.record_generator(start_record)
-    for i in range(start_record, start_record + number_of_records):
-        record = next(rg)
-        assert record == f"Hey this is my record {i:,}"
+    assert list(islice(rg, number_of_records)) == expected_records
     cfr.close()
-    end = time.time()
+    end = time.perf_counter_ns()
     LOGGER.info(
         f"Elapsed time reading and validating {number_of_records:,} records starting at"
-        f" record {start_record:,} = {end-start}s"
+        f" record {start_record:,} = {throughput(number_of_records, end - start)}"
     )